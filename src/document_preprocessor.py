@@ -1,21 +1,100 @@
 import argparse
+import bisect
+import codecs
+import hashlib
+import html
+import itertools
 import os
 import re
 import tiktoken
 
 from bs4 import BeautifulSoup
 
+__all__ = [
+    "DocumentPreprocessor",
+    "N_TOKENS_TARGET", "MAX_CHARS_SEARCH", "CHUNK_OVERLAP",
+    "SENTENCE_ENDINGS", "WORDS_BREAKS"
+]
+
+# 分割するトークン数の目安
+N_TOKENS_TARGET = 1000
+
+# 句読点を探す文字数の上限
+MAX_CHARS_SEARCH = 100
+
+# チャンク同士で重ねる文字数
+CHUNK_OVERLAP = 100
+
+# XMLパーサーがそのまま扱える定義済み実体参照
+_XML_ENTITIES = {"&amp;", "&lt;", "&gt;", "&quot;", "&apos;"}
+
+# 実体参照、あるいは裸の&にマッチする
+_ENTITY_RE = re.compile(r"&(#[0-9]+;|#x[0-9a-fA-F]+;|[a-zA-Z][a-zA-Z0-9]*;)?")
+
+# 行頭の空白(改行を除く)にマッチする
+_LSTRIP_RE = re.compile(r"^[^\S\n]+", re.MULTILINE)
+
+# 3つ以上連続する改行にマッチする
+_BLANK_RE = re.compile(r"\n{3,}")
+
+# 文の終わりとみなす文字
+SENTENCE_ENDINGS = frozenset([
+    ".", "!", "?", "．", "。", "！", "？"
+])
+
+# 単語の区切りとみなす文字
+WORDS_BREAKS = frozenset([
+    ",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n",
+    "，", "、", "；", "：", "　", "（", "）", "「", "」", "『", "』", "【", "】", "｛", "｝"
+])
+
+# 句読点をまとめて探すための正規表現。グループ1が文の終わり、グループ2が単語の区切り
+_BOUNDARY_RE = re.compile(
+    "([" + re.escape("".join(SENTENCE_ENDINGS)) + "])"
+    + "|([" + re.escape("".join(WORDS_BREAKS)) + "])")
+
+
+def _resolve_entity(match: re.Match) -> str:
+    """
+    XMLパーサーが解釈できない実体参照と裸の&をXMLとして扱える形に変換する
+    """
+
+    entity = match.group()
+
+    # 裸の&はエスケープする
+    if match.group(1) is None:
+        return "&amp;"
+
+    # 定義済み実体参照と数値文字参照はそのまま渡す
+    if entity in _XML_ENTITIES or entity.startswith("&#"):
+        return entity
+
+    # HTMLの実体参照として解決を試みる。例: &mdash; -> —
+    resolved = html.unescape(entity)
+
+    if resolved != entity and resolved not in "<>&\"'":
+        return resolved
+
+    # 解決できなかった実体参照はテキストとして残す
+    return "&amp;" + match.group(1)
+
 
 class DocumentPreprocessor():
     def __init__(self, openai_model: str):
         self.openai_model = openai_model
 
-    def create_chunks(self, content: str) -> list:
+        # モデルからエンコーディングを求めるのは重い処理のため、一度だけ行って使い回す
+        self._encoding = tiktoken.encoding_for_model(openai_model)
+
+        # 同じテキストを二度トークン化しないためのキャッシュ
+        self._chunk_cache: dict[bytes, list[str]] = {}
+
+    def create_chunks(self, content: str) -> list[str]:
         """
         HTML/SGMLのデータからテキストを取り出して整形し、LLMが扱いやすいサイズに分割する
         """
 
-        struct = BeautifulSoup(content, "html.parser")
+        struct = self._parse_sgml(content)
 
         # <xref>の情報がget_text()で消えてしまうためテキストに置換しておく
         # 例: <xref linkend="app-pgdump"/> -> app-pgdump
@@ -26,140 +105,167 @@ class DocumentPreprocessor():
         text = struct.get_text()
 
         # 行頭の空白を削除する
-        text = "\n".join([line.lstrip() for line in text.split("\n")])
+        text = _LSTRIP_RE.sub("", text)
 
         # 3つ以上連続する改行を2つに置換する
-        text = re.sub("\n{3,}", "\n\n", text)
+        text = _BLANK_RE.sub("\n\n", text)
 
         # LLMが扱いやすいサイズに分割する
         chunks = self._chunk_text(text)
 
         return chunks
 
-    def _chunk_text(self, text: str) -> list:
+    def create_chunks_with_hash(self, content: str) -> list[tuple[str, str]]:
         """
-        テキストをLLMが扱いやすいサイズに分割する
+        create_chunksの結果に内容のSHA-256ハッシュを付けて返す
 
-        参考: https://github.com/Azure-Samples/azure-search-openai-demo/blob/main/scripts/prepdocslib/textsplitter.py
-        - 区切り文字に日本語の句読点を追加
-        - 文字数ではなくトークン数で数えるように変更
+        埋め込みモデルの呼び出し側がハッシュをキーにキャッシュを引けるようにする。
+        定型文などで内容が同一になったチャンクは最初の1つだけを残す
         """
 
-        # 分割するトークン数の目安
-        N_TOKENS_TARGET = 1000
+        chunks_with_hash = []
+        seen = set()
+
+        for chunk in self.create_chunks(content):
+            chunk_hash = hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
+            if chunk_hash in seen:
+                continue
 
-        # 句読点を探す文字数の上限
-        MAX_CHARS_SEARCH = 100
+            seen.add(chunk_hash)
+            chunks_with_hash.append((chunk_hash, chunk))
 
-        # チャンク同士で重ねる文字数
-        CHUNK_OVERLAP = 100
+        return chunks_with_hash
 
-        SENTENCE_ENDINGS = [
-            ".", "!", "?", "．", "。", "！", "？"
-        ]
+    def _parse_sgml(self, content: str) -> BeautifulSoup:
+        """
+        HTML/SGMLのデータをパースする
+
+        純Python実装のhtml.parserより大幅に速い、C実装のlxmlのXMLパーサーを使う。
+        XMLとして扱えるように実体参照を解決し、
+        ルート要素が複数あるファイルに備えてルート要素で包んでおく
+        """
 
-        WORDS_BREAKS = [
-            ",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n",
-            "，", "、", "；", "：", "　", "（", "）", "「", "」", "『", "』", "【", "】", "｛", "｝"
-        ]
+        content = _ENTITY_RE.sub(_resolve_entity, content)
+
+        return BeautifulSoup(f"<sgml>{content}</sgml>", "lxml-xml")
+
+    def _chunk_text(self, text: str) -> list[str]:
+        """
+        テキストをLLMが扱いやすいサイズに分割する
+
+        参考: https://github.com/Azure-Samples/azure-search-openai-demo/blob/main/scripts/prepdocslib/textsplitter.py
+        - 区切り文字に日本語の句読点を追加
+        - 文字数ではなくトークン数で数えるように変更
+        """
+
+        # 同一のテキストは一度だけ分割する
+        # 巨大な文字列をキーとして持ち続けないようにハッシュをキーにする
+        cache_key = hashlib.blake2b(
+            text.encode("utf-8"), digest_size=16).digest()
+        cached = self._chunk_cache.get(cache_key)
+
+        if cached is not None:
+            return list(cached)
+
+        # ループ内での名前解決を速くするため、ローカル変数に束縛しておく
+        n_tokens_target = N_TOKENS_TARGET
+        max_chars_search = MAX_CHARS_SEARCH
+        chunk_overlap = CHUNK_OVERLAP
+
+        # テキスト全体を一度だけトークン化し、各トークン境界が何文字目に当たるのかを
+        # 求めておく
+        tokens = self._encoding.encode(text)
+        token_bytes_list = self._encoding.decode_tokens_bytes(tokens)
+        char_offsets = [0]
+
+        if text.isascii():
+            # ASCIIのみのテキストはバイト数と文字数が一致するため、
+            # バイト数の累積和がそのまま文字オフセットになる
+            char_offsets.extend(itertools.accumulate(
+                map(len, token_bytes_list)))
+        else:
+            # マルチバイト文字がトークンをまたぐことがあるため、
+            # バイト列をインクリメンタルにデコードしながら文字数を数える
+            utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+            n_chars = 0
+
+            for token_bytes in token_bytes_list:
+                n_chars += len(utf8_decoder.decode(token_bytes))
+                char_offsets.append(n_chars)
 
         chunks = []
         length = len(text)
         start = 0     # 切り取り開始位置
         end = length  # 切り取り終了位置
 
-        while start + CHUNK_OVERLAP < length:
+        while start + chunk_overlap < length:
             """
             textからtext[start:end]を取り出す。
             start、endを仮決めして、startを前方、endを後方に句読点が見つかるまで広げていく
             """
 
+            # startを含むトークンからN_TOKENS_TARGET個分でendを仮決めする
+            token_index = bisect.bisect_right(char_offsets, start) - 1
+            end = char_offsets[min(token_index + n_tokens_target, len(tokens))]
+
+            # endから後方に向かって句読点を正規表現で探す。MAX_CHARS_SEARCHだけ探したらやめる
+            search_end = min(length, end + max_chars_search)
+            sentence_pos = -1
             last_word = -1
-            n_chars = self._calc_char_length_from_tokens(
-                text[start:], N_TOKENS_TARGET)
-            end = start + n_chars
 
-            if end > length:
-                end = length
+            for match in _BOUNDARY_RE.finditer(text, end, search_end):
+                if match.lastindex == 1:
+                    # 最初に見つかった読点で打ち切る
+                    sentence_pos = match.start()
+                    break
+
+                last_word = match.start()
+
+            if sentence_pos != -1:
+                end = sentence_pos
+            elif search_end == length or text[search_end] in SENTENCE_ENDINGS:
+                # テキストの末尾まで探したか、探索範囲の直後が読点の場合はそこで区切る
+                end = search_end
             else:
-                # start + n_charsのところから後方に向かって読点を探す。SEARCH_LIMITだけ探したらやめる
-                while (
-                    end < length
-                    and end < start + n_chars + MAX_CHARS_SEARCH
-                    and text[end] not in SENTENCE_ENDINGS
-                ):
-                    # 句点だった場合はメモしておく
-                    if text[end] in WORDS_BREAKS:
-                        last_word = end
-                    end += 1
-
-                if (
-                    end < length
-                    and text[end] not in SENTENCE_ENDINGS
-                    and last_word > 0
-                ):
-                    # 読点が見つからなかったが句点は見つかった場合、句点を区切りにする
-                    end = last_word
+                # 読点が見つからなかったが句点は見つかった場合、句点を区切りにする
+                end = last_word if last_word > 0 else search_end
 
             if end < length:
                 end += 1  # 位置を次の文の先頭にする
 
-            last_word = -1
             start_origin = start
 
-            # startのところから前方に向かって読点を探す。SEARCH_LIMITだけ探したらやめる
-            while (
-                start > 0
-                and start > start_origin - MAX_CHARS_SEARCH
-                and text[start] not in SENTENCE_ENDINGS
-            ):
-                if text[start] in WORDS_BREAKS:
-                    # 句点だった場合はメモしておく
-                    last_word = start
-                start -= 1
-
-            if (
-                text[start] not in SENTENCE_ENDINGS
-                and last_word > 0
-            ):
+            # startから前方に向かって句読点を正規表現で探す。MAX_CHARS_SEARCHだけ探したらやめる
+            search_start = max(0, start_origin - max_chars_search)
+            sentence_pos = -1
+            first_word = -1
+
+            for match in _BOUNDARY_RE.finditer(text, search_start, start_origin + 1):
+                if match.lastindex == 1:
+                    # 最後に見つかった読点を採用する
+                    sentence_pos = match.start()
+                elif first_word == -1 and match.start() > search_start:
+                    first_word = match.start()
+
+            if sentence_pos != -1:
+                start = sentence_pos
+            else:
                 # 読点が見つからなかったが句点は見つかった場合、句点を区切りにする
-                start = last_word
+                start = first_word if first_word > 0 else search_start
 
             if start > 0:
                 start += 1  # 位置を次の文の先頭にする
 
             chunks.append(text[start:end])
-            start = end - CHUNK_OVERLAP
+            start = end - chunk_overlap
 
-        if start + CHUNK_OVERLAP < end:
+        if start + chunk_overlap < end:
             chunks.append(text[start:end])
 
-        return chunks
-
-    def _calc_char_length_from_tokens(self, text: str, n_tokens_target: int) -> int:
-        """
-        テキストの先頭から指定数のトークンを取り出すと何文字になるのかを求める
-        """
-
-        encoding = tiktoken.encoding_for_model(self.openai_model)
-        low = 0
-        high = len(text)
-
-        # 二分探索
-        while low <= high:
-            mid = (low + high) // 2
-            n_tokens = len(encoding.encode(text[:mid]))
+        self._chunk_cache[cache_key] = list(chunks)
 
-            if n_tokens == n_tokens_target:
-                return mid
-
-            if n_tokens < n_tokens_target:
-                low = mid + 1
-            else:
-                high = mid - 1
-
-        # ぴったり合うとは限らない。近ければ良い
-        return (low + high) // 2
+        return chunks
 
 
 if __name__ == "__main__":
@@ -178,10 +284,12 @@ if __name__ == "__main__":
         content = f.read()
 
     chunks = preprocessor.create_chunks(content)
-    encoding = tiktoken.encoding_for_model(openai_model)
 
-    for i, chunk in enumerate(chunks):
-        print(str(i) + ":" + str(len(encoding.encode(chunk))) +
+    # チャンクごとにencode()を呼ぶのではなく、一度のバッチ呼び出しで並列に数える
+    token_list_list = preprocessor._encoding.encode_ordinary_batch(chunks)
+
+    for i, (chunk, token_list) in enumerate(zip(chunks, token_list_list)):
+        print(str(i) + ":" + str(len(token_list)) +
               ":" + chunk[:50].replace("\n", " "))
 
     print("\n========================================\n".join(chunks))
@@ -1,14 +1,22 @@
 import argparse
 import os
-import re
-import tiktoken
 
-from bs4 import BeautifulSoup, Tag
+from bs4 import CData, NavigableString, Tag
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from document_preprocessor import DocumentPreprocessor
+from document_preprocessor import DocumentPreprocessor, _BLANK_RE, _LSTRIP_RE
 
+__all__ = [
+    "DocumentPreprocessorCustom", "Section", "MAX_SECTION_CHARS"
+]
 
-@dataclass
+# 一度にトークン化するテキストの文字数の上限
+# tiktokenは長大な入力に対して超線形に遅くなるため、
+# 長いセクションは段落の境界でこの文字数以下のまとまりに分けてから処理する
+MAX_SECTION_CHARS = 8000
+
+
+@dataclass(slots=True, frozen=True)
 class Section:
     document: str
     chapter: str
@@ -22,7 +30,7 @@ class DocumentPreprocessorCustom(DocumentPreprocessor):
         super().__init__(openai_model)
         self.document_name = document_name
 
-    def create_chunks(self, content: str) -> list:
+    def create_chunks(self, content: str) -> list[str]:
         """
         SGMLのデータから文書の構造を取り出して整形し、LLMが扱いやすいサイズに分割する
         """
@@ -30,43 +38,81 @@ class DocumentPreprocessorCustom(DocumentPreprocessor):
         chunks = []
         section_list: list[Section] = self._extract_section_list(content)
 
-        for section in section_list:
-            text = section.text
+        # セクション同士は独立していて、tiktokenが内部でGILを解放するため、
+        # スレッドで並列に処理する。mapを使うことでセクションの順序は保たれる
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for section_chunks in executor.map(self._process_section, section_list):
+                chunks.extend(section_chunks)
+
+        return chunks
+
+    def _process_section(self, section: Section) -> list[str]:
+        """
+        セクションのテキストを整形し、分割したチャンクに見出しを付ける
+        """
 
-            # 行頭の空白を削除する
-            text = "\n".join([line.lstrip() for line in text.split("\n")])
+        chunks = []
+        text = section.text
 
-            # 3つ以上連続する改行を2つに置換する
-            text = re.sub("\n{3,}", "\n\n", text)
+        # 行頭の空白を削除する
+        text = _LSTRIP_RE.sub("", text)
 
-            # 分割する
+        # 3つ以上連続する改行を2つに置換する
+        text = _BLANK_RE.sub("\n\n", text)
+
+        # 分割する。長いセクションは段落の境界でまとまりに分けてから渡す
+        if len(text) <= MAX_SECTION_CHARS:
             text_chunk_list = self._chunk_text(text)
+        else:
+            text_chunk_list = []
+            group_parts = []
+            group_length = 0
+
+            # 整形済みのテキストでは段落の区切りは常に空行1つになっている
+            for paragraph in text.split("\n\n"):
+                if group_parts and group_length + len(paragraph) > MAX_SECTION_CHARS:
+                    text_chunk_list.extend(
+                        self._chunk_text("\n\n".join(group_parts)))
+                    group_parts = []
+                    group_length = 0
 
-            for text_chunk in text_chunk_list:
-                text_temp = []
-                text_temp.append(f"# {section.document}")
+                group_parts.append(paragraph)
+                group_length += len(paragraph) + 2
 
-                if section.chapter:
-                    text_temp.append(f"## {section.chapter}")
+            if group_parts:
+                text_chunk_list.extend(
+                    self._chunk_text("\n\n".join(group_parts)))
 
-                if section.sect1:
-                    text_temp.append(f"### {section.sect1}")
+        # 見出しはセクションごとに一度だけ組み立てる
+        header_parts = []
+        header_parts.append(f"# {section.document}")
 
-                if section.sect2:
-                    text_temp.append(f"#### {section.sect2}")
+        if section.chapter:
+            header_parts.append(f"## {section.chapter}")
 
-                text_temp.append(text_chunk)
-                chunks.append("\n".join(text_temp))
+        if section.sect1:
+            header_parts.append(f"### {section.sect1}")
+
+        if section.sect2:
+            header_parts.append(f"#### {section.sect2}")
+
+        header = "\n".join(header_parts) + "\n"
+
+        for text_chunk in text_chunk_list:
+            chunks.append(header + text_chunk)
 
         return chunks
 
-    def _extract_section_list(self, content: str) -> list:
+    def _extract_section_list(self, content: str) -> list[Section]:
         """
         SGMLのデータから<chapter><sect1><sect2>の構造を取り出す
+
+        ツリーを一度だけ走査し、どの階層のテキストを読んでいるのかを
+        状態として持ちながらセクションを組み立てる
         """
 
         section_list = []
-        struct = BeautifulSoup(content, "html.parser")
+        struct = self._parse_sgml(content)
 
         # <xref>の情報がget_text()で消えてしまうためテキストに置換しておく
         # 例: <xref linkend="app-pgdump"/> -> app-pgdump
@@ -78,55 +124,92 @@ class DocumentPreprocessorCustom(DocumentPreprocessor):
         chapter_list: list[Tag] = struct.find_all(["chapter", "preface"])
 
         # <chapter>あるいは<preface>がなく、いきなり<sect1>から始まるファイルへの対応
+        # _parse_sgmlが包んだルート要素をチャプター相当として扱う
         if chapter_list == []:
-            chapter_list = [struct]
+            chapter_list = struct.contents
 
         for chapter in chapter_list:
             chapter_title = self._find_direct_child_title(chapter)
-            chapter_text = chapter.get_text()
-
-            # <sect1>
-            sect1_list: list[Tag] = chapter.find_all("sect1")
-            for sect1 in sect1_list:
-                sect1_title = self._find_direct_child_title(sect1)
-                sect1_text = sect1.get_text()
-
-                # <chapter>の内側で<sect1>の外側にあるテキストを取り出す
-                chapter_text_splitted = chapter_text.split(sect1_text)
-                chapter_text_preface = chapter_text_splitted[0]
-                chapter_text = sect1_text.join(chapter_text_splitted[1:])
-
-                # <chapter>の序文があれば出力する
-                if chapter_text_preface.split():
-                    section_list.append(
-                        Section(self.document_name, chapter_title, "", "", chapter_text_preface))
-
-                # <sect2>
-                sect2_list: list[Tag] = sect1.find_all("sect2")
-                for sect2 in sect2_list:
-                    sect2_title = self._find_direct_child_title(sect2)
-                    sect2_text = sect2.get_text()
-
-                    # <sect1>の内側で<sect2>の外側にあるテキストを取り出す
-                    sect1_text_splitted = sect1_text.split(sect2_text)
-                    sect1_text_preface = sect1_text_splitted[0]
-                    sect1_text = sect2_text.join(sect1_text_splitted[1:])
-
-                    # <sect1>の序文があれば出力する
-                    if sect1_text_preface.split():
+            sect1 = None
+            sect1_title = ""
+            sect2 = None
+            sect2_title = ""
+            chapter_parts = []
+            sect1_parts = []
+            sect2_parts = []
+
+            # (ノード, 出るときに立てるフラグ)のスタックでツリーを一度だけ走査する
+            stack = [(child, False) for child in reversed(chapter.contents)]
+
+            while stack:
+                node, leaving = stack.pop()
+
+                # テキストは現在の階層のバッファに集める
+                # コメントなどはget_text()と同様に除外する
+                if isinstance(node, NavigableString):
+                    if type(node) not in (NavigableString, CData):
+                        continue
+
+                    if sect2 is not None:
+                        sect2_parts.append(str(node))
+                    elif sect1 is not None:
+                        sect1_parts.append(str(node))
+                    else:
+                        chapter_parts.append(str(node))
+
+                    continue
+
+                if leaving:
+                    if node is sect2:
+                        # <sect2>を出力する
+                        section_list.append(Section(
+                            self.document_name, chapter_title, sect1_title, sect2_title, "".join(sect2_parts)))
+                        sect2 = None
+                        sect2_parts = []
+                    elif node is sect1:
+                        # <sect1>の残りがあれば出力する
+                        sect1_text = "".join(sect1_parts)
+
+                        if sect1_text.split():
+                            section_list.append(
+                                Section(self.document_name, chapter_title, sect1_title, "", sect1_text))
+
+                        sect1 = None
+                        sect1_parts = []
+
+                    continue
+
+                if sect1 is None and node.name == "sect1" and node.parent is chapter:
+                    # <sect1>に入る。ここまでに集めた<chapter>の序文があれば出力する
+                    chapter_preface = "".join(chapter_parts)
+                    chapter_parts = []
+
+                    if chapter_preface.split():
                         section_list.append(
-                            Section(self.document_name, chapter_title, sect1_title, "", sect1_text_preface))
+                            Section(self.document_name, chapter_title, "", "", chapter_preface))
 
-                    # <sect2>を出力する
-                    section_list.append(Section(
-                        self.document_name, chapter_title, sect1_title, sect2_title, sect2_text))
+                    sect1 = node
+                    sect1_title = self._find_direct_child_title(node)
+                    stack.append((node, True))
+                elif sect2 is None and node.name == "sect2" and node.parent is sect1:
+                    # <sect2>に入る。ここまでに集めた<sect1>の序文があれば出力する
+                    sect1_preface = "".join(sect1_parts)
+                    sect1_parts = []
 
-                # <sect1>の残りがあれば出力する
-                if sect1_text.split():
-                    section_list.append(
-                        Section(self.document_name, chapter_title, sect1_title, "", sect1_text))
+                    if sect1_preface.split():
+                        section_list.append(
+                            Section(self.document_name, chapter_title, sect1_title, "", sect1_preface))
+
+                    sect2 = node
+                    sect2_title = self._find_direct_child_title(node)
+                    stack.append((node, True))
+
+                stack.extend((child, False)
+                             for child in reversed(node.contents))
 
             # <chapter>の残りがあれば出力する
+            chapter_text = "".join(chapter_parts)
+
             if chapter_text.split():
                 section_list.append(
                     Section(self.document_name, chapter_title, "", "", chapter_text))
@@ -173,10 +256,12 @@ if __name__ == "__main__":
         content = f.read()
 
     chunks = preprocessor.create_chunks(content)
-    encoding = tiktoken.encoding_for_model(openai_model)
 
-    for i, chunk in enumerate(chunks):
-        print(str(i) + ":" + str(len(encoding.encode(chunk))) +
+    # チャンクごとにencode()を呼ぶのではなく、一度のバッチ呼び出しで並列に数える
+    token_list_list = preprocessor._encoding.encode_ordinary_batch(chunks)
+
+    for i, (chunk, token_list) in enumerate(zip(chunks, token_list_list)):
+        print(str(i) + ":" + str(len(token_list)) +
               ":" + chunk[:200].replace("\n", " "))
 
     print("\n========================================\n".join(chunks))